@@ -1,27 +1,33 @@
 
 from mediafire import distributed_download_urls, download_url
 
+import os
 import re
+import mmap
 import asyncio
 
-def get_links_from_file(filepath : str) -> list[str]:
-	url_pattern = re.compile(r'https?://[^\s]+')
-	links = []
-	with open(filepath, 'r', encoding='utf-8') as file:
-		for line in file.readlines():
-			links.extend(url_pattern.findall(line))
-	return [item for item in links if item is not None]
+try:
+	from uvloop import run as run_async # faster event loop where available (not on Windows)
+except ImportError:
+	run_async = asyncio.run
+
+URL_PATTERN = re.compile(rb'https?://[^\s"\'<>]+')
+
+def get_links_from_file(filepath : str, contains : bytes = b'www.mediafire.com') -> list[str]:
+	if os.path.getsize(filepath) == 0: # empty files cannot be mmapped
+		return []
+	with open(filepath, 'rb') as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+		return [match.group().decode('utf-8', errors='ignore') for match in URL_PATTERN.finditer(mm) if contains in match.group()]
 
 if __name__ == '__main__':
 	# from file example
 	urls : list[str] = get_links_from_file("bookmarks.html")
-	urls : list[str] = [item for item in urls if "www.mediafire.com" in item]
 	print(len(urls))
 	directory : str = 'downloads'
 	simultaneous : int = 1
-	_ = asyncio.run(distributed_download_urls(urls, directory, simultaneous=simultaneous))
+	_ = run_async(distributed_download_urls(urls, directory, simultaneous=simultaneous))
 
 	# using url example
 	# url : str = ''
 	# directory : str = 'downloads'
-	# asyncio.run(download_url(url, directory))
+	# run_async(download_url(url, directory))
@@ -1,79 +1,160 @@
 
 import re
+import html
 import os
 import aiohttp
 import json
-import gazpacho
 import asyncio
 import hashlib
-import requests
+import multiprocessing
+import concurrent.futures
 
 from typing import Union
 from tqdm import tqdm
 
+try:
+	from orjson import loads as json_loads
+except ImportError:
+	json_loads = json.loads
+
+def update_hasher(hasher : "hashlib._Hash", filepath : str) -> None:
+	with open(filepath, "rb", buffering=0) as f:
+		buffer = bytearray(1 << 20)
+		view = memoryview(buffer)
+		while n := f.readinto(buffer):
+			hasher.update(view[:n])
+
 def hash_file(filepath : str) -> str:
+	if hasattr(hashlib, 'file_digest'):
+		with open(filepath, "rb", buffering=0) as f:
+			return hashlib.file_digest(f, "sha256").hexdigest()
 	hasher = hashlib.sha256()
-	with open(filepath, "rb") as f:
-		for chunk in iter(lambda: f.read(1024), b""):
-			hasher.update(chunk)
+	update_hasher(hasher, filepath)
 	return hasher.hexdigest()
 
+HASH_PROCESS_THRESHOLD = 256 << 20
+_hash_pool : Union[concurrent.futures.ProcessPoolExecutor, None] = None
+async def hash_file_async(filepath : str) -> str:
+	'''Hash off the event loop - large files go to a process pool so several can be hashed on separate cores.'''
+	global _hash_pool
+	if os.path.getsize(filepath) < HASH_PROCESS_THRESHOLD:
+		return await asyncio.to_thread(hash_file, filepath)
+	if _hash_pool is None:
+		# spawn rather than fork: by now the process has worker threads whose locks a forked child would inherit
+		_hash_pool = concurrent.futures.ProcessPoolExecutor(max_workers=os.cpu_count(), mp_context=multiprocessing.get_context('spawn'))
+	return await asyncio.get_running_loop().run_in_executor(_hash_pool, hash_file, filepath)
+
+def shutdown_hash_pool() -> None:
+	global _hash_pool
+	if _hash_pool is not None:
+		_hash_pool.shutdown()
+		_hash_pool = None
+
+WRITE_BUFFER_SIZE = 1 << 20
 HEADERS = {'User-Agent' : 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/129.0.0.0 Safari/537.36'}
-async def async_get(url : str) -> Union[str, None]:
-	# async with aiohttp.ClientSession(headers=HEADERS) as session:
-	# 	response = await session.get(url, allow_redirects=True)
-	# 	with open('response.html', 'w') as file:
-	# 		file.write(await response.text())
-	# 	response.raise_for_status()
-	# 	return await response.text()
-	return requests.get(url, headers=HEADERS).text
-
-async def download_file(url : str, filepath : str, chunk_size : int = 32) -> None:
-	async with aiohttp.ClientSession(headers=HEADERS) as session:
-		response : aiohttp.ClientResponse = await session.get(url, allow_redirects=True)
+def create_session(simultaneous : int = 1) -> aiohttp.ClientSession:
+	'''Create a ClientSession whose connection pool is shared by every request of a bulk run.'''
+	# headroom beyond the streaming downloads so folder walkers and listing prefetches can overlap them
+	pool_size = simultaneous * FOLDER_WALKERS + FOLDER_CHUNK_PREFETCH
+	connector = aiohttp.TCPConnector(limit=pool_size, limit_per_host=pool_size, ttl_dns_cache=300, enable_cleanup_closed=True)
+	# no total timeout: it would also count time spent queued for a pooled connection and long file bodies
+	timeout = aiohttp.ClientTimeout(total=None, sock_connect=30, sock_read=60)
+	return aiohttp.ClientSession(headers=HEADERS, connector=connector, timeout=timeout)
+
+async def async_get(session : aiohttp.ClientSession, url : str) -> Union[str, None]:
+	async with session.get(url, allow_redirects=True) as response:
+		response.raise_for_status()
+		return await response.text()
+
+async def async_get_json(session : aiohttp.ClientSession, url : str) -> dict:
+	async with session.get(url, allow_redirects=True) as response:
+		response.raise_for_status()
+		return json_loads(await response.read())
+
+async def write_response(response : aiohttp.ClientResponse, filepath : str, chunk_size : int = 1 << 17, offset : int = 0, hasher : Union["hashlib._Hash", None] = None, desc : Union[str, None] = None) -> bool:
+	'''Stream an open response into filepath, appending after offset. Written bytes are also fed to hasher, if any.'''
+	total_size = offset + int(response.headers.get('Content-Length', 0))
+	if total_size > 15e8: return False
+	progress_bar = tqdm(total=total_size, initial=offset, unit='B', unit_scale=True, mininterval=0.25, miniters=1 << 20, desc=desc or os.path.basename(filepath))
+	with open(filepath, 'ab' if offset > 0 else 'wb') as file:
+		def flush(data : bytes) -> None:
+			if hasher is not None:
+				hasher.update(data)
+			file.write(data)
+		buffer : list[bytes] = []
+		buffered = 0
+		async for chunk in response.content.iter_chunked(chunk_size):
+			if chunk:
+				buffer.append(chunk)
+				buffered += len(chunk)
+				progress_bar.update(len(chunk))
+			if buffered >= WRITE_BUFFER_SIZE:
+				await asyncio.to_thread(flush, b"".join(buffer))
+				buffer.clear()
+				buffered = 0
+		if buffer:
+			await asyncio.to_thread(flush, b"".join(buffer))
+	progress_bar.close()
+	return True
+
+async def download_file(session : aiohttp.ClientSession, url : str, filepath : str, chunk_size : int = 1 << 17) -> bool:
+	async with session.get(url, allow_redirects=True) as response:
+		response.raise_for_status()
+		return await write_response(response, filepath, chunk_size=chunk_size)
+
+async def download_file_verified(session : aiohttp.ClientSession, url : str, filepath : str, expected_hash : str, chunk_size : int = 1 << 17, offset : int = 0) -> bool:
+	'''Download into a '.part' file while hashing it, and only move it to filepath if the SHA-256 matches.'''
+	part_filepath = filepath + '.part'
+	hasher = hashlib.sha256()
+	if offset > 0:
+		# hash the existing prefix before the request so the connection is never left idle
+		await asyncio.to_thread(update_hasher, hasher, part_filepath)
+	headers = {'Range' : f'bytes={offset}-'} if offset > 0 else None
+	async with session.get(url, allow_redirects=True, headers=headers) as response:
 		response.raise_for_status()
-		total_size = int(response.headers.get('Content-Length', 0))
-		if total_size > 15e8: return
-		progress_bar = tqdm(total=total_size, unit='B', unit_scale=True, desc=os.path.basename(filepath))
-		with open(filepath, 'wb') as file:
-			async for chunk in response.content.iter_chunked(chunk_size):
-				if chunk:
-					file.write(chunk)
-					progress_bar.update(len(chunk))
-		progress_bar.close()
-
-async def bulk_download_files(url_filepath_tuples : list[tuple[str, str]], simultaneous : int = 1, chunk_size : int = 32) -> list[bool]:
+		if response.status != 206:
+			offset = 0 # server ignored the range, start from scratch
+			hasher = hashlib.sha256()
+		if not await write_response(response, part_filepath, chunk_size=chunk_size, offset=offset, hasher=hasher, desc=os.path.basename(filepath)):
+			raise ValueError(f'Skipped {filepath}: larger than the 1.5 GB download limit')
+	if hasher.hexdigest() != expected_hash:
+		os.remove(part_filepath)
+		raise ValueError(f'SHA-256 mismatch for {filepath}')
+	os.replace(part_filepath, filepath)
+	return True
+
+async def bulk_download_files(url_filepath_tuples : list[tuple[str, str]], simultaneous : int = 1, chunk_size : int = 1 << 17) -> list[bool]:
 	semaphore = asyncio.Semaphore(simultaneous)
+	session = create_session(simultaneous)
 	async def sem_download(url, filepath):
 		nonlocal chunk_size
 		async with semaphore:
 			print(f'Starting download: {url}')
 			try:
-				await download_file(url, filepath, chunk_size=chunk_size)
-				success = True
+				await download_file(session, url, filepath, chunk_size=chunk_size)
 			except Exception as e:
-				print(e)
-				success = False
+				print(f'Failed to download {url}: {e!r}')
+				return False
 			print(f'Successfully downloaded: {url}')
-			return success
+			return True
 	tasks = [sem_download(url, filepath) for (url, filepath) in url_filepath_tuples]
 	print(f'Starting bulk download of {len(url_filepath_tuples)} items.')
-	results = await asyncio.gather(*tasks)
+	async with session:
+		results = await asyncio.gather(*tasks)
 	print(f'Finished bulk download of {len(url_filepath_tuples)} items.')
 	return results
 
 
-async def get_mfkey_from_url(url : str) -> Union[tuple[str, str], tuple[None, None]]:
-	file_or_folder_pattern : str = r"mediafire\.com/(folder|file)\/([a-zA-Z0-9]+)"
-	fof_matches = re.findall(file_or_folder_pattern, url)
-	if fof_matches is None or len(fof_matches) == 0:
+MFKEY_PATTERN = re.compile(r"mediafire\.com/(folder|file)/([a-zA-Z0-9]+)")
+def get_mfkey_from_url(url : str) -> Union[tuple[str, str], tuple[None, None]]:
+	fof_match = MFKEY_PATTERN.search(url)
+	if fof_match is None:
 		return (None, None)
-	return fof_matches[0]
+	return fof_match.groups()
 
-async def get_mediafire_file_data(file_key : str) -> dict:
+async def get_mediafire_file_data(session : aiohttp.ClientSession, file_key : str) -> dict:
 	url = f"https://www.mediafire.com/api/file/get_info.php?quick_key={file_key}&response_format=json"
-	content = await async_get(url)
-	return json.loads(content)['response']['file_info']
+	return (await async_get_json(session, url))['response']['file_info']
 
 async def get_mediafire_folder_data(file_type : str, folder_key : str, chunk : int = 1, info : bool = False) -> tuple:
 	return (
@@ -83,111 +164,170 @@ async def get_mediafire_folder_data(file_type : str, folder_key : str, chunk : i
 		f"&version=1.5&folder_key={folder_key}&response_format=json"
 	)
 
-async def get_download_url_from_file(url : str) -> Union[str, None]:
+DOWNLOAD_BUTTON_PATTERN = re.compile(r'<a\b[^>]*\bclass="[^"]*\binput popsok\b[^"]*"[^>]*>')
+HREF_PATTERN = re.compile(r'\bhref="([^"]+)"')
+async def get_download_url_from_file(session : aiohttp.ClientSession, url : str) -> Union[str, None]:
 	try:
-		html = await async_get(url)
-		soup = gazpacho.Soup(html)
-		download_url = soup.find("div", {"class": "download_link"}) \
-			.find("a", {"class": "input popsok"}) \
-			.attrs["href"]
-		return download_url
+		page = await async_get(session, url)
+		button = DOWNLOAD_BUTTON_PATTERN.search(page)
+		href = button and HREF_PATTERN.search(button.group())
+		if not href:
+			raise ValueError(f'No download link found on {url}')
+		return html.unescape(href.group(1))
 	except Exception as e:
 		print(e)
 		return None
 
-async def parse_filename(filename : str) -> str:
-	chars = [char if (char.isalnum() or char in "-_. ") else "-" for char in filename]
-	return "".join(chars)
+FILENAME_TABLE = {code : (chr(code) if (chr(code).isalnum() or chr(code) in "-_. ") else "-") for code in range(128)}
+def parse_filename(filename : str) -> str:
+	if filename.isascii():
+		return filename.translate(FILENAME_TABLE)
+	return "".join([char if (char.isalnum() or char in "-_. ") else "-" for char in filename])
 
-async def dnld_file(url : str, directory : str) -> None:
+async def dnld_file(session : aiohttp.ClientSession, url : str, directory : str) -> bool:
 	'''Download the given MediaFire file.'''
-	_, url_key = await get_mfkey_from_url(url)
+	_, url_key = get_mfkey_from_url(url)
 	os.makedirs(directory, exist_ok=True)
-	file_data : dict = await get_mediafire_file_data(url_key)
+	file_data : dict = await get_mediafire_file_data(session, url_key)
+	return await dnld_file_data(session, file_data, directory)
+
+async def dnld_file_data(session : aiohttp.ClientSession, file_data : dict, directory : str, check_existing : bool = True) -> bool:
+	'''Download a MediaFire file from its already-fetched info (as returned by get_info or a folder listing).'''
 	file_first_link : str = file_data["links"]["normal_download"]
-	file_dnld_link : str = await get_download_url_from_file(file_first_link)
-	filename : str = await parse_filename(file_data["filename"])
+	file_dnld_link : str = await get_download_url_from_file(session, file_first_link)
+	filename : str = parse_filename(file_data["filename"])
 	filepath = os.path.join(directory, filename)
-	if os.path.exists(filepath) and file_data['hash'] == hash_file(filepath):
+	part_filepath = filepath + '.part'
+	offset = 0
+	if os.path.exists(filepath) or os.path.exists(part_filepath):
+		remote_size = int(file_data.get('size', 0))
+		if os.path.exists(filepath):
+			local_size = os.path.getsize(filepath)
+			if remote_size == 0 or local_size == remote_size:
+				if check_existing and file_data['hash'] == await hash_file_async(filepath):
+					return True
+			elif local_size < remote_size:
+				os.replace(filepath, part_filepath) # incomplete file from an older run, resume it
+		if os.path.exists(part_filepath) and os.path.getsize(part_filepath) < remote_size:
+			offset = os.path.getsize(part_filepath)
+	return await download_file_verified(session, file_dnld_link, filepath, file_data['hash'], chunk_size=1 << 17, offset=offset)
+
+FOLDER_CHUNK_PREFETCH = 4
+async def get_folder_content(session : aiohttp.ClientSession, content_type : str, folder_key : str) -> list[dict]:
+	'''Page through every chunk of a folder listing and return its 'files' or 'folders' entries.'''
+	async def get_chunk(chunk : int) -> dict:
+		response_json : dict = await async_get_json(session, await get_mediafire_folder_data(content_type, folder_key, chunk=chunk))
+		return response_json["response"]["folder_content"]
+	# most folders fit in one chunk; only prefetch ahead once we know there are more
+	folder_content : dict = await get_chunk(1)
+	data : list[dict] = list(folder_content.get(content_type, []))
+	more_chunks = folder_content["more_chunks"] == "yes"
+	chunk = 2
+	while more_chunks:
+		batch = await asyncio.gather(*(get_chunk(chunk + i) for i in range(FOLDER_CHUNK_PREFETCH)), return_exceptions=True)
+		for folder_content in batch:
+			if isinstance(folder_content, BaseException):
+				raise folder_content
+			data.extend(folder_content.get(content_type, []))
+			more_chunks = folder_content["more_chunks"] == "yes"
+			if not more_chunks:
+				break # discard any chunks requested past the end
+		chunk += FOLDER_CHUNK_PREFETCH
+	return data
+
+async def needs_download(file_data : dict, directory : str) -> bool:
+	'''Check whether a listed file is missing or differs locally, only hashing when the size matches.'''
+	filepath = os.path.join(directory, parse_filename(file_data["filename"]))
+	if not os.path.exists(filepath):
+		return True
+	remote_size = int(file_data.get('size', 0))
+	if remote_size != 0 and os.path.getsize(filepath) != remote_size:
 		return True
-	await download_file(file_dnld_link, filepath, chunk_size=32)
+	return file_data['hash'] != await hash_file_async(filepath)
 
-async def dnld_folder_items(folder_key : str, directory : str) -> None:
+async def dnld_folder_items(session : aiohttp.ClientSession, folder_key : str, directory : str) -> None:
 	'''Download all items in the mediafire folder.'''
 	os.makedirs(directory, exist_ok=True)
-	data : list[dict] = []
-	chunk = 1
-	more_chunks = True
-	try:
-		while more_chunks:
-			content : str = await async_get(await get_mediafire_folder_data('files', folder_key, chunk=chunk))
-			response_json = json.loads(content)
-			more_chunks = response_json["response"]["folder_content"]["more_chunks"] == "yes"
-			data.extend(response_json["response"]["folder_content"]["files"])
-			chunk += 1
-	except:
-		return
-	urls : list[str] = []
-	for file_data in data:
-		filename : str = await parse_filename(file_data["filename"])
-		filepath = os.path.join(directory, filename)
-		if os.path.exists(filepath) and file_data['hash'] == hash_file(filepath):
-			continue
-		file_first_link : str = file_data["links"]["normal_download"]
-		urls.append(file_first_link)
+	data : list[dict] = await get_folder_content(session, 'files', folder_key)
+	needs : list[bool] = await asyncio.gather(*(needs_download(file_data, directory) for file_data in data))
+	pending : list[dict] = [file_data for file_data, need in zip(data, needs) if need]
 	results = []
-	print(f'Starting bulk download of {len(urls)} items.')
-	for url in urls:
+	print(f'Starting bulk download of {len(pending)} items.')
+	for file_data in pending:
 		try:
-			results.append(await dnld_file(url, directory))
-		except:
-			pass
-	print(f'Finished bulk download of {len(urls)} items.')
+			results.append(await dnld_file_data(session, file_data, directory, check_existing=False))
+		except Exception as e:
+			print(f'Failed to download {file_data["filename"]}: {e!r}')
+			results.append(False)
+	print(f'Finished bulk download of {len(pending)} items.')
 	return results
 
-async def dnld_folder(folder_key : str, directory : str, is_root_folder : bool = False) -> None:
+FOLDER_WALKERS = 4
+async def dnld_folder(session : aiohttp.ClientSession, folder_key : str, directory : str, is_root_folder : bool = False, semaphore : Union[asyncio.Semaphore, None] = None) -> None:
 	'''Download the given MediaFire folder - also iterates over nested folders.'''
-	if is_root_folder is True:
-		folder_url : str = await get_mediafire_folder_data('folders', folder_key, info=True)
-		content : str = await async_get(folder_url)
-		folder_name : str = json.loads(content)["response"]["folder_info"]["name"]
-		directory = os.path.join(directory, await parse_filename(folder_name))
-	os.makedirs(directory, exist_ok=True)
-	await dnld_folder_items(folder_key, directory)
-	folder_content = json.loads(
-		await async_get(await get_mediafire_folder_data("folders", folder_key))
-	)["response"]["folder_content"]
-	if "folders" in folder_content:
-		for folder in folder_content["folders"]:
-			subdir : str = os.path.join(directory, folder["name"])
-			await dnld_folder(folder["folderkey"], subdir, is_root_folder=False)
-
-async def download_url(url : str, directory : str) -> None:
-	url_type, url_key = await get_mfkey_from_url(url)
+	if semaphore is None:
+		semaphore = asyncio.Semaphore(FOLDER_WALKERS)
+	# only a folder's own work holds a slot, not the wait on its subfolders, so deep trees cannot deadlock
+	async with semaphore:
+		if is_root_folder is True:
+			folder_url : str = await get_mediafire_folder_data('folders', folder_key, info=True)
+			response_json : dict = await async_get_json(session, folder_url)
+			folder_name : str = response_json["response"]["folder_info"]["name"]
+			directory = os.path.join(directory, parse_filename(folder_name))
+		os.makedirs(directory, exist_ok=True)
+		# wait for both before propagating errors so a failed listing never leaves downloads running
+		items_result, folders = await asyncio.gather(
+			dnld_folder_items(session, folder_key, directory),
+			get_folder_content(session, "folders", folder_key),
+			return_exceptions=True,
+		)
+		for result in (items_result, folders):
+			if isinstance(result, BaseException):
+				raise result
+	results = await asyncio.gather(*(
+		dnld_folder(session, folder["folderkey"], os.path.join(directory, folder["name"]), is_root_folder=False, semaphore=semaphore)
+		for folder in folders
+	), return_exceptions=True)
+	failed = [(folder, result) for folder, result in zip(folders, results) if isinstance(result, BaseException)]
+	for folder, result in failed:
+		print(f'Failed to download folder {os.path.join(directory, folder["name"])}: {result!r}')
+	if failed:
+		raise RuntimeError(f'{len(failed)} subfolder(s) of {directory} failed to download')
+
+async def download_url(url : str, directory : str, session : Union[aiohttp.ClientSession, None] = None) -> None:
+	if session is None:
+		async with create_session() as session:
+			return await download_url(url, directory, session=session)
+	url_type, url_key = get_mfkey_from_url(url)
 	if url_type is None:
 		raise ValueError('Invalid Mediafire URL!')
 	if url_type == "file":
-		await dnld_file(url, directory)
+		await dnld_file(session, url, directory)
 	elif url_type == "folder":
-		await dnld_folder(url_key, directory, is_root_folder=True)
+		await dnld_folder(session, url_key, directory, is_root_folder=True)
 	else:
 		raise ValueError('Unsupported Mediafire URL type!')
 
 async def distributed_download_urls(urls : list[str], directory : str, simultaneous : int = 1) -> list[bool]:
+	urls = list(dict.fromkeys(urls))
 	semaphore = asyncio.Semaphore(simultaneous)
+	session = create_session(simultaneous)
 	async def sem_download(url):
 		async with semaphore:
 			print(f'Starting download: {url}')
 			try:
-				await download_url(url, directory)
-				success = True
+				await download_url(url, directory, session=session)
 			except Exception as e:
-				print(e)
-				success = False
+				print(f'Failed to download {url}: {e!r}')
+				return False
 			print(f'Successfully downloaded: {url}')
-			return success
+			return True
 	tasks = [sem_download(url) for url in urls]
 	print(f'Starting bulk download of {len(urls)} items.')
-	results = await asyncio.gather(*tasks)
+	try:
+		async with session:
+			results = await asyncio.gather(*tasks)
+	finally:
+		shutdown_hash_pool()
 	print(f'Finished bulk download of {len(urls)} items.')
 	return results